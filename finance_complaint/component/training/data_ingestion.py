@@ -1,45 +1,146 @@
 import os
 import re
 import sys
+import threading
 import time
 import uuid
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
-import json
+import ijson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 
 from finance_complaint.config.pipeline.training import FinanceConfig
-from finance_complaint.config.spark_manager import spark_session
+from finance_complaint.constant.training_pipeline_config import DATA_INGESTION_WRITE_BATCH_SIZE, \
+    DATA_INGESTION_READ_BUFFER_SIZE
 from finance_complaint.entity.artifact_entity import DataIngestionArtifact
 from finance_complaint.entity.config_entity import DataIngestionConfig
 from finance_complaint.entity.metadata_entity import DataIngestionMetadata
+from finance_complaint.entity.schema import FinanceDataSchema
 from finance_complaint.exception import FinanceException
 from finance_complaint.logger import logger
 from datetime import datetime
 
 DownloadUrl = namedtuple("DownloadUrl", ["url", "file_path", "n_retry"])
 
+# connect and read timeout in seconds of download request
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# number of seconds to wait mentioned in throttled response
+WAIT_SECOND_PATTERN = re.compile(rb"\d+")
+
+
+class UnexpectedResponseError(Exception):
+    """
+    Raised when downloaded response is not a json array of records such as throttling message
+    content: head of the response
+    """
+
+    def __init__(self, content: bytes):
+        super().__init__(f"Expected json array of records but response starts with: {content[:100]}")
+        self.content = content
+
+
+class HeadStream:
+    """
+    File like object which returns already read head of stream before rest of the stream
+    """
+
+    def __init__(self, head: bytes, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b""
+        if len(self.head) > 0:
+            head, self.head = self.head, b""
+            return head
+        return self.stream.read(size)
+
+
+def write_parquet_file(stream, file_path: str, schema: pa.Schema) -> None:
+    """
+    Parses complaint records from json stream and writes them into parquet file.
+    It does not depend on DataIngestion state hence it can be executed in any worker.
+
+    stream: file like object of downloaded json
+    file_path: parquet file path
+    schema: schema of complaint records
+    =======================================================================================
+    Errors are raised with their original type so that caller can decide whether download can be retried.
+    """
+    # records are returned as json array, any other response such as throttling message is a failure
+    head = stream.read(DATA_INGESTION_READ_BUFFER_SIZE)
+    if not head.lstrip().startswith(b"["):
+        raise UnexpectedResponseError(content=head)
+
+    # only _source of each hit is built as python object, records are parsed one at a time
+    # as they are read from the stream and collected column wise into record batches of parquet file
+    with pq.ParquetWriter(file_path, schema, compression="snappy", use_dictionary=True) as writer:
+        columns = {column: [] for column in schema.names}
+        # bound append of each column list is looked up once per batch instead of once per value
+        appenders = [(column, columns[column].append) for column in schema.names]
+        n_record = 0
+        for record in ijson.items(HeadStream(head=head, stream=stream), "item._source", use_float=True,
+                                  buf_size=DATA_INGESTION_READ_BUFFER_SIZE):
+            get_value = record.get
+            for column, append in appenders:
+                append(get_value(column))
+            n_record += 1
+            if n_record == DATA_INGESTION_WRITE_BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+                columns = {column: [] for column in schema.names}
+                appenders = [(column, columns[column].append) for column in schema.names]
+                n_record = 0
+        if n_record > 0:
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+
 
 class DataIngestion:
     # Used to download data in chunks.
-    def __init__(self, data_ingestion_config: DataIngestionConfig, n_retry: int = 5, ):
+    def __init__(self, data_ingestion_config: DataIngestionConfig, n_retry: int = 5, n_worker: int = 8, ):
         """
         data_ingestion_config: Data Ingestion config
-        n_retry: Number of retry filed should be tried to download in case of failure encountered
+        n_retry: Number of retry of failed request and of download interrupted while reading response
         n_month_interval: n month data will be downloded
+        n_worker: Number of files downloaded concurrently
         """
         try:
             logger.info(f"{'>>' * 20}Starting data ingestion.{'<<' * 20}")
             self.data_ingestion_config = data_ingestion_config
             self.failed_download_urls: List[DownloadUrl] = []
+            # failed urls are appended from download worker threads
+            self.failed_download_urls_lock = threading.Lock()
             self.n_retry = n_retry
+            self.n_worker = n_worker
+            # shared session so that connections are reused across download workers
+            self.session = requests.Session()
+            # throttled and failed requests are retried with exponential backoff on the pooled connections,
+            # connection pool is sized to number of workers so that no worker opens a throwaway connection
+            retry = Retry(total=n_retry, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                          raise_on_status=False)
+            self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=n_worker, max_retries=retry))
+            self.request_params = {'User-agent': f'your bot {uuid.uuid4()}'}
+            self.schema: pa.Schema = FinanceDataSchema().source_data_schema
+            # intervals are prepared once and reused
+            self.required_interval: List[str] = None
+            self.datasource_url_template: str = data_ingestion_config.datasource_url \
+                .replace("<todate>", "{to_date}").replace("<fromdate>", "{from_date}")
 
         except Exception as e:
             raise FinanceException(e, sys)
 
     def get_required_interval(self):
+        if self.required_interval is not None:
+            return self.required_interval
         start_date = datetime.strptime(self.data_ingestion_config.from_date, "%Y-%m-%d")
         end_date = datetime.strptime(self.data_ingestion_config.to_date, "%Y-%m-%d")
         n_diff_days = (end_date - start_date).days
@@ -54,15 +155,16 @@ class DataIngestion:
         if freq is None:
             intervals = pd.date_range(start=self.data_ingestion_config.from_date,
                                       end=self.data_ingestion_config.to_date,
-                                      periods=2).astype('str').tolist()
+                                      periods=2).strftime("%Y-%m-%d").tolist()
         else:
 
             intervals = pd.date_range(start=self.data_ingestion_config.from_date,
                                       end=self.data_ingestion_config.to_date,
-                                      freq=freq).astype('str').tolist()
+                                      freq=freq).strftime("%Y-%m-%d").tolist()
         logger.debug(f"Prepared Interval: {intervals}")
         if self.data_ingestion_config.to_date not in intervals:
             intervals.append(self.data_ingestion_config.to_date)
+        self.required_interval = intervals
         return intervals
 
     def download_files(self, n_day_interval_url: int = None):
@@ -74,111 +176,139 @@ class DataIngestion:
         try:
             required_interval = self.get_required_interval()
             logger.info("Started downloading files")
+            download_urls: List[DownloadUrl] = []
             for index in range(1, len(required_interval)):
                 from_date, to_date = required_interval[index - 1], required_interval[index]
                 logger.debug(f"Generating data download url between {from_date} and {to_date}")
-                datasource_url: str = self.data_ingestion_config.datasource_url
-                url = datasource_url.replace("<todate>", to_date).replace("<fromdate>", from_date)
+                url = self.datasource_url_template.format(to_date=to_date, from_date=from_date)
                 logger.debug(f"Url: {url}")
-                file_name = f"{self.data_ingestion_config.file_name}_{from_date}_{to_date}.json"
+                file_name = f"{self.data_ingestion_config.file_name}_{from_date}_{to_date}.parquet"
                 file_path = os.path.join(self.data_ingestion_config.download_dir, file_name)
-                download_url = DownloadUrl(url=url, file_path=file_path, n_retry=self.n_retry)
-                self.download_data(download_url=download_url)
+                download_urls.append(DownloadUrl(url=url, file_path=file_path, n_retry=self.n_retry))
+
+            # creating download directory once instead of in every download worker
+            os.makedirs(self.data_ingestion_config.download_dir, exist_ok=True)
+
+            # downloads are network bound hence requests are overlapped using threads
+            with ThreadPoolExecutor(max_workers=self.n_worker) as executor:
+                list(executor.map(self.download_data, download_urls))
             logger.info(f"File download completed")
         except Exception as e:
             raise FinanceException(e, sys)
 
     def convert_files_to_parquet(self, ) -> str:
         """
-        downloaded files will be converted and merged into single parquet file
-        json_data_dir: downloaded json file directory
-        data_dir: converted and combined file will be generated in data_dir
+        downloaded parquet files will be moved into feature store parquet directory
+        parquet_data_dir: downloaded parquet file directory
+        data_dir: combined parquet directory will be generated in data_dir
         output_file_name: output file name 
         =======================================================================================
         returns output_file_path
         """
         try:
-            json_data_dir = self.data_ingestion_config.download_dir
+            parquet_data_dir = self.data_ingestion_config.download_dir
             data_dir = self.data_ingestion_config.feature_store_dir
             output_file_name = self.data_ingestion_config.file_name
             os.makedirs(data_dir, exist_ok=True)
             file_path = os.path.join(data_dir, f"{output_file_name}")
             logger.info(f"Parquet file will be created at: {file_path}")
-            if not os.path.exists(json_data_dir):
+            if not os.path.exists(parquet_data_dir):
                 return file_path
-            for file_name in os.listdir(json_data_dir):
-                json_file_path = os.path.join(json_data_dir, file_name)
-                logger.debug(f"Converting {json_file_path} into parquet format at {file_path}")
-                df = spark_session.read.json(json_file_path)
-                if df.count() > 0:
-                    df.write.mode('append').parquet(file_path)
+            with os.scandir(parquet_data_dir) as entries:
+                parquet_file_paths = [entry.path for entry in entries
+                                      if entry.is_file() and entry.name.endswith(".parquet")]
+            os.makedirs(file_path, exist_ok=True)
+            for parquet_file_path in parquet_file_paths:
+                # downloaded files are already in parquet format hence only moved into dataset directory,
+                # previously ingested files are kept as only new interval is downloaded on each run
+                logger.debug(f"Moving {parquet_file_path} into {file_path}")
+                os.replace(parquet_file_path, os.path.join(file_path, os.path.basename(parquet_file_path)))
             return file_path
         except Exception as e:
             raise FinanceException(e, sys)
 
-    def retry_download_data(self, data, download_url: DownloadUrl):
+    def save_failed_download(self, download_url: DownloadUrl, content: bytes = None):
         """
-        This function help to avoid failure as it help to download failed file again
-        
-        data:failed response
+        This function keeps record of download failed after all retries
+
         download_url: DownloadUrl
+        content: body of failed response if available
         """
         try:
-            # if retry still possible try else return the response
-            if download_url.n_retry == 0:
+            with self.failed_download_urls_lock:
                 self.failed_download_urls.append(download_url)
-                logger.info(f"Unable to download file {download_url.url}")
+            logger.info(f"Unable to download file {download_url.url}")
+            if content is None:
                 return
 
-            # to handle throatling requestion and can be slove if we wait for some second.
-            content = data.content.decode("utf-8")
-            wait_second = re.findall(r'\d+', content)
-
-            if len(wait_second) > 0:
-                time.sleep(int(wait_second[0]) + 2)
-
             # Writing response to understand why request was failed
             failed_file_path = os.path.join(self.data_ingestion_config.failed_dir,
                                             os.path.basename(download_url.file_path))
             os.makedirs(self.data_ingestion_config.failed_dir, exist_ok=True)
             with open(failed_file_path, "wb") as file_obj:
-                file_obj.write(data.content)
-
-            # calling download function again to retry
-            download_url = DownloadUrl(download_url.url, file_path=download_url.file_path,
-                                       n_retry=download_url.n_retry - 1)
-            self.download_data(download_url=download_url)
+                file_obj.write(content)
         except Exception as e:
             raise FinanceException(e, sys)
 
     def download_data(self, download_url: DownloadUrl):
         try:
             logger.info(f"Starting download operation: {download_url}")
-            download_dir = os.path.dirname(download_url.file_path)
-
-            # creating download directory
-            os.makedirs(download_dir, exist_ok=True)
-
-            # downloading data
-            data = requests.get(download_url.url, params={'User-agent': f'your bot {uuid.uuid4()}'})
-
-            try:
-                logger.info(f"Started writing downloaded data into json file: {download_url.file_path}")
-                # saving downloaded data into hard disk
-                with open(download_url.file_path, "w") as file_obj:
-                    finance_complaint_data = list(map(lambda x: x["_source"],
-                                                      filter(lambda x: "_source" in x.keys(),
-                                                             json.loads(data.content)))
-                                                  )
-
-                    json.dump(finance_complaint_data, file_obj)
-                logger.info(f"Downloaded data has been written into file: {download_url.file_path}")
-            except Exception as e:
-                logger.info("Failed to download hence retry again.")
-                # removing file failed file exist
-                if os.path.exists(download_url.file_path):
-                    os.remove(download_url.file_path)
-                self.retry_download_data(data, download_url=download_url)
+            # completed interval files end up in feature store, an interval is skipped if a previous run moved it
+            # there but failed before updating metadata, otherwise its records would be ingested twice
+            feature_store_file_path = os.path.join(self.data_ingestion_config.feature_store_dir,
+                                                   self.data_ingestion_config.file_name,
+                                                   os.path.basename(download_url.file_path))
+            if os.path.exists(feature_store_file_path):
+                logger.info(f"File already present in feature store hence skipping: {feature_store_file_path}")
+                return
+            part_file_path = f"{download_url.file_path}.part"
+
+            # failed and throttled requests are retried by session, download interrupted while
+            # reading response or response which is not a list of records is retried here
+            failed_content = None
+            for n_retry in range(download_url.n_retry, -1, -1):
+                failed_content = None
+                try:
+                    # downloading data, response body is streamed instead of being buffered in memory
+                    with self.session.get(download_url.url, params=self.request_params, timeout=DOWNLOAD_TIMEOUT,
+                                          stream=True) as data:
+                        # failed response body is small and kept for investigation
+                        if data.status_code != 200:
+                            logger.info(f"Download failed with status code: {data.status_code}")
+                            failed_content = data.content
+                            break
+                        logger.info(f"Started writing downloaded data into parquet file: {download_url.file_path}")
+                        data.raw.decode_content = True
+                        # saving downloaded data into hard disk
+                        write_parquet_file(stream=data.raw, file_path=part_file_path, schema=self.schema)
+                    os.replace(part_file_path, download_url.file_path)
+                    logger.info(f"Downloaded data has been written into file: {download_url.file_path}")
+                    return
+                except UnexpectedResponseError as e:
+                    # to handle throatling message, it is kept for investigation and mentions seconds to wait
+                    logger.info(f"Failed to download hence retry again, remaining retry {n_retry}: {e}")
+                    failed_content = e.content
+                    if n_retry > 0:
+                        wait_second = WAIT_SECOND_PATTERN.search(failed_content)
+                        if wait_second is not None:
+                            time.sleep(int(wait_second.group()) + 2)
+                        else:
+                            time.sleep(2 ** (download_url.n_retry - n_retry))
+                except (ProtocolError, ReadTimeoutError, ijson.IncompleteJSONError) as e:
+                    # response was interrupted or incomplete hence download is tried again
+                    logger.info(f"Failed to download hence retry again, remaining retry {n_retry}: {e}")
+                    if n_retry > 0:
+                        time.sleep(2 ** (download_url.n_retry - n_retry))
+                except Exception as e:
+                    # request errors are already retried by session, schema and disk errors
+                    # would fail again on every retry
+                    logger.info(f"Failed to download: {e}")
+                    break
+
+            # removing file failed file exist
+            if os.path.exists(part_file_path):
+                os.remove(part_file_path)
+            self.save_failed_download(download_url=download_url, content=failed_content)
 
         except Exception as e:
             logger.info(e)
@@ -204,12 +334,12 @@ class DataIngestion:
 
     def initiate_data_ingestion(self) -> DataIngestionArtifact:
         try:
-            logger.info(f"Started downloading json file")
+            logger.info(f"Started downloading parquet file")
             if self.data_ingestion_config.from_date != self.data_ingestion_config.to_date:
                 self.download_files()
 
             if os.path.exists(self.data_ingestion_config.download_dir):
-                logger.info(f"Converting and combining downloaded json into parquet file")
+                logger.info(f"Combining downloaded parquet files into feature store")
                 file_path = self.convert_files_to_parquet()
                 self.write_metadata(file_path=file_path)
 
@@ -6,6 +6,10 @@ DATA_INGESTION_FEATURE_STORE_DIR = "feature_store"
 DATA_INGESTION_FAILED_DIR = "failed_downloaded_files"
 DATA_INGESTION_METADATA_FILE_NAME = "meta_info.yaml"
 DATA_INGESTION_MIN_START_DATE = "2011-12-01"
+# number of downloaded records written to parquet file as one record batch
+DATA_INGESTION_WRITE_BATCH_SIZE = 10000
+# number of bytes read from download response at once while parsing
+DATA_INGESTION_READ_BUFFER_SIZE = 1024 * 1024
 DATA_INGESTION_DATA_SOURCE_URL = f"https://www.consumerfinance.gov/data-research/consumer-complaints/search/api/v1/" \
                       f"?date_received_max=<todate>&date_received_min=<fromdate>" \
                       f"&field=all&format=json"
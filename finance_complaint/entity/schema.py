@@ -1,4 +1,5 @@
 from typing import List
+import pyarrow as pa
 from pyspark.sql.types import TimestampType, StringType, FloatType, StructType, StructField
 from finance_complaint.exception import FinanceException
 import os, sys
@@ -27,6 +28,41 @@ class FinanceDataSchema:
         self.col_sub_product: str = "sub_product"
         self.col_complaint_what_happened: str = "complaint_what_happened"
         self.col_company_public_response: str = "company_public_response"
+        self.col_sub_issue: str = "sub_issue"
+        self.col_tags: str = "tags"
+        self.col_has_narrative: str = "has_narrative"
+
+    @property
+    def source_data_schema(self) -> pa.Schema:
+        """
+        Schema of complaint records downloaded from data source api
+        """
+        try:
+            schema = pa.schema([
+                pa.field(self.col_company_response, pa.string()),
+                pa.field(self.col_consumer_consent_provided, pa.string()),
+                pa.field(self.col_submitted_via, pa.string()),
+                pa.field(self.col_timely, pa.string()),
+                pa.field(self.col_date_sent_to_company, pa.string()),
+                pa.field(self.col_date_received, pa.string()),
+                pa.field(self.col_company, pa.string()),
+                pa.field(self.col_issue, pa.string()),
+                pa.field(self.col_sub_issue, pa.string()),
+                pa.field(self.col_product, pa.string()),
+                pa.field(self.col_sub_product, pa.string()),
+                pa.field(self.col_state, pa.string()),
+                pa.field(self.col_zip_code, pa.string()),
+                pa.field(self.col_consumer_disputed, pa.string()),
+                pa.field(self.col_complaint_id, pa.string()),
+                pa.field(self.col_complaint_what_happened, pa.string()),
+                pa.field(self.col_company_public_response, pa.string()),
+                pa.field(self.col_tags, pa.string()),
+                pa.field(self.col_has_narrative, pa.bool_()),
+            ])
+            return schema
+
+        except Exception as e:
+            raise FinanceException(e, sys) from e
 
     @property
     def dataframe_schema(self) -> StructType: